@@ -1,86 +1,267 @@
-import requests
-import json
+import gzip
+import time
+import base64
+import threading
+import httpx
+import orjson
+import ijson
+from cachetools import TTLCache
 import logging
-from typing import Generator
+from typing import ContextManager, Generator, Union
 
 # Configure the logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Byte budget of the query cache and the largest cached query result
+_QUERY_CACHE_BYTES = 64 * 1024 * 1024
+_QUERY_CACHE_MAX_ENTRY = 4 * 1024 * 1024
+# Results with more documents are not cached, which also spares encoding them
+_QUERY_CACHE_MAX_DOCS = 1000
+
 class Db():
-    def __init__(self, host: str, port: int, database: str, username: str, password: str) -> None:
+    def __init__(self, host: str, port: int, database: str, username: str, password: str, compress: bool = False) -> None:
         '''
         host: str: Hostname of the CouchDB server
         port: int: Port number of the CouchDB server
         database: str: Name of the database
         username: str: Username for the CouchDB server
         password: str: Password for the CouchDB server
+        compress: bool: Gzip the request bodies sent to the server
         '''
-        self.session = requests.Session()
-        self.session.headers.update({'Content-Type': 'application/json'})
-        self.session.auth = (username, password)
-
         self._url = f"{host}:{port}/{database}"
+
+        # Pooled keep-alive connections, paths are relative to the database. httpx only negotiates HTTP/2 through
+        # TLS ALPN, so it is used when an https proxy in front of CouchDB offers it, CouchDB itself serves HTTP/1.1
+        transport = httpx.HTTPTransport(http2=True, retries=3, limits=httpx.Limits(max_connections=128, max_keepalive_connections=128))
+        # Encode the basic auth credentials once instead of running an auth flow on every request
+        token = base64.b64encode(f"{username}:{password}".encode()).decode()
+        self.session = httpx.Client(
+            base_url=self._url,
+            headers={'Content-Type': 'application/json', 'Accept-Encoding': 'gzip, deflate', 'Authorization': f'Basic {token}'},
+            transport=transport,
+            timeout=None,
+        )
+
+        # Absolute endpoint URLs built once, httpx sends them without parsing and merging with base_url per request
+        self._find_url = httpx.URL(f"{self._url}/_find")
+        self._bulk_url = httpx.URL(f"{self._url}/_bulk_docs")
+        self._all_docs_url = httpx.URL(f"{self._url}/_all_docs")
+        self._changes_url = httpx.URL(f"{self._url}/_changes")
+        self._compact_url = httpx.URL(f"{self._url}/_compact")
+        self._cleanup_url = httpx.URL(f"{self._url}/_view_cleanup")
+        self._purge_url = httpx.URL(f"{self._url}/_purge")
+        self._revs_limit_url = httpx.URL(f"{self._url}/_revs_limit")
+        self._compress = compress
+
+        # Recently read documents and query results, kept as raw JSON so every hit returns a fresh copy
+        self._doc_cache = TTLCache(maxsize=10_000, ttl=60)
+        # The query cache is bounded by the total size of the cached JSON, results above _QUERY_CACHE_MAX_ENTRY are not cached
+        self._query_cache = TTLCache(maxsize=_QUERY_CACHE_BYTES, ttl=5, getsizeof=len)
+        self._cache_lock = threading.Lock()
+        # Bumped by every invalidation, reads only fill the cache if no write happened while they were in flight
+        self._cache_generation = 0
         
         logger.info(f"Connected to CouchDB at {self._url}")
 
+    def _request(self, method: str, url: Union[str, httpx.URL], idempotent: bool = None, **kwargs) -> httpx.Response:
+        '''
+        method: str: HTTP method
+        url: str | URL: Request URL
+        idempotent: bool: Whether the request can be repeated safely, defaults to True for GET, HEAD and PUT
+
+        Sends the request. Idempotent requests are retried up to 3 times with a short backoff while the server answers
+        502, 503 or 504. Other requests are sent once, as a proxy error can arrive after CouchDB already committed the write
+        '''
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD', 'PUT')
+        if not idempotent:
+            return self.session.request(method, url, **kwargs)
+
+        for attempt in range(3):
+            res = self.session.request(method, url, **kwargs)
+            if res.status_code not in (502, 503, 504):
+                return res
+            time.sleep(0.1 * 2 ** attempt)
+        return self.session.request(method, url, **kwargs)
+
+    def _json_body(self, obj) -> dict:
+        '''
+        obj: Object to be serialized as the JSON request body, bytes are sent as already encoded JSON
+
+        Returns the request arguments carrying the object serialized with orjson, gzipped when compression is enabled.
+        Non string dict keys are written as strings like json.dumps does, integers must fit in 64 bits
+        '''
+        data = obj if isinstance(obj, bytes) else orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        if self._compress:
+            return {'content': gzip.compress(data, compresslevel=1), 'headers': {'Content-Encoding': 'gzip'}}
+        return {'content': data}
+
+    def _post_json(self, url: Union[str, httpx.URL], obj, idempotent: bool = False, **kwargs) -> httpx.Response:
+        '''
+        url: str | URL: Request URL
+        obj: Object to be serialized as the JSON request body
+        idempotent: bool: Set for read only endpoints such as _find and _all_docs, so the request is retried on 502, 503 or 504
+
+        Posts the given object serialized with orjson
+        '''
+        return self._request('POST', url, idempotent=idempotent, **self._json_body(obj), **kwargs)
+
+    def _put_json(self, url: Union[str, httpx.URL], obj, **kwargs) -> httpx.Response:
+        '''
+        url: str | URL: Request URL
+        obj: Object to be serialized as the JSON request body
+
+        Puts the given object serialized with orjson
+        '''
+        return self._request('PUT', url, **self._json_body(obj), **kwargs)
+
+    def _stream_json(self, url: Union[str, httpx.URL], obj, **kwargs) -> ContextManager[httpx.Response]:
+        '''
+        url: str | URL: Request URL
+        obj: Object to be serialized as the JSON request body
+
+        Posts the given object serialized with orjson, the response body is read while it is being consumed
+        '''
+        return self.session.stream('POST', url, **self._json_body(obj), **kwargs)
+
+    @staticmethod
+    def _decode(res: httpx.Response):
+        '''
+        res: Response: HTTP response
+
+        Returns the JSON body of the response decoded with orjson
+        '''
+        return orjson.loads(res.content)
+
+    @staticmethod
+    def _iter_items(res: httpx.Response, prefix: str) -> Generator[dict, None, None]:
+        '''
+        res: Response: Streamed HTTP response
+        prefix: str: ijson prefix of the items to yield, e.g. 'docs.item'
+
+        Parses the response body incrementally and yields the matching items as they arrive
+        '''
+        items = ijson.sendable_list()
+        parser = ijson.items_coro(items, prefix, use_float=True)
+        for chunk in res.iter_bytes():
+            parser.send(chunk)
+            yield from items
+            del items[:]
+        parser.close()
+        yield from items
+
+    def _invalidate(self, ids: list) -> None:
+        '''
+        ids: list: IDs of the documents that were written
+
+        Drops the written documents and all query results from the cache
+        '''
+        with self._cache_lock:
+            self._cache_generation += 1
+            for id in ids:
+                self._doc_cache.pop(id, None)
+            self._query_cache.clear()
+
     def get(self, id: str) -> dict:
         '''
         id: str: Document ID
         
         Returns the document with the given ID
         '''
-        res = self.session.get(f"{self._url}/{id}")
+        with self._cache_lock:
+            cached = self._doc_cache.get(id)
+            generation = self._cache_generation
+        if cached is not None:
+            return orjson.loads(cached)
+
+        res = self._request('GET', f"/{id}")
         if res.status_code != 200:
             return None
         
-        return res.json()
+        with self._cache_lock:
+            if generation == self._cache_generation:
+                self._doc_cache[id] = res.content
+        return self._decode(res)
+
+    def get_projected(self, id: str, fields: list) -> dict:
+        '''
+        id: str: Document ID
+        fields: list: List of fields to return
+
+        Returns the given fields of the document with the given ID. Goes through _find, so the result is cached like find results
+        '''
+        return self.find_first(query={"_id": id}, fields=fields)
+
+    def bulk_get(self, ids: list) -> list:
+        '''
+        ids: list: Document IDs
+
+        Returns the documents with the given IDs, fetched with a single request. Missing or deleted documents are skipped
+        '''
+        res = self._post_json(self._all_docs_url, {"keys": ids}, idempotent=True, params={'include_docs': 'true'})
+        if res.status_code != 200:
+            return []
+
+        return [row['doc'] for row in self._decode(res)['rows'] if row.get('doc')]
     
-    def post(self, doc: dict) -> dict:
+    def post(self, doc: dict, batch: bool = False, body: bytes = None) -> dict:
         '''
         doc: dict: Document to be inserted
+        batch: bool: Use batch mode, CouchDB acknowledges the write before it is committed to disk
+        body: bytes: Document already encoded as JSON, sent instead of doc which then only receives the _id and _rev
         
         Inserts the given document into the database. Uses the CouchDB uuid to generate the _id
         
-        Returns the inserted document with the _id and _rev
+        Returns the inserted document with the _id and _rev. In batch mode the _rev is None
         '''
-        res = self.session.post(f"{self._url}", json=doc)
-        if res.status_code != 201:
+        res = self._post_json("/", doc if body is None else body, params={'batch': 'ok'} if batch else None)
+        if res.status_code not in [201, 202]:
             return None
         
-        res = res.json()
-        doc['_id'], doc['_rev'] = res['id'], res['rev']
+        res = self._decode(res)
+        doc['_id'], doc['_rev'] = res['id'], res.get('rev')
+        self._invalidate([doc['_id']])
         return doc
     
-    def put(self, doc: dict) -> dict:
+    def put(self, doc: dict, batch: bool = False, body: bytes = None) -> dict:
         '''
         doc: dict: Document to be updated
+        batch: bool: Use batch mode, CouchDB acknowledges the write before it is committed to disk
+        body: bytes: Document already encoded as JSON, sent instead of doc which then only needs the _id and receives the _rev
         
         Updates the given document in the database
         
-        Returns the updated document with the new _rev
+        Returns the updated document with the new _rev. In batch mode the _rev is None
         '''
 
         # If the document does not have an _id, insert it
         if doc.get('_id', None) is None:
-            return self.post(doc)
+            return self.post(doc, batch=batch, body=body)
+
+        params = {'batch': 'ok'} if batch else None
         
         # If the document has a _rev and is None, remove it (for ORM integration)
         if '_rev' in doc and doc['_rev'] is None:
             doc.pop('_rev', None)
         
-        result = self.session.put(f"{self._url}/{doc['_id']}", json=doc)
-        if result.status_code not in [200, 201]:
-            # If there is a document conflict, get the current document and update it
-            current_doc = self.get(doc['_id'])
-            if current_doc:
-                current_doc.update(doc)
-                result = self.session.put(f"{self._url}/{current_doc['_id']}", json=current_doc)
-            else:
+        result = self._put_json(f"/{doc['_id']}", doc if body is None else body, params=params)
+        if result.status_code == 409:
+            # If there is a document conflict, read the current revision from the ETag and retry once
+            current = self._request('HEAD', f"/{doc['_id']}")
+            if current.status_code != 200:
                 return None
+            doc['_rev'] = current.headers['ETag'].strip('"')
+            if body is not None:
+                body = orjson.dumps({**orjson.loads(body), '_rev': doc['_rev']})
+            result = self._put_json(f"/{doc['_id']}", doc if body is None else body, params=params)
+
+        if result.status_code not in [200, 201, 202]:
+            return None
         
-        res = result.json()
-        doc['_rev'] = res['rev']
+        res = self._decode(result)
+        doc['_rev'] = res.get('rev')
+        self._invalidate([doc['_id']])
         return doc
     
     def bulk_update(self, docs: list) -> list:
@@ -89,14 +270,37 @@ class Db():
         
         Updates the given documents in the database
         
-        Returns the updated documents with the new _rev
+        Returns the updated documents with the new _rev. Raises RuntimeError listing the per document errors
+        if some documents could not be written, the written ones still get their new _rev
         '''
         # Remove the _rev field if it is empty (first time insert)
-        [doc.pop('_rev', None) for doc in docs if not doc.get('_rev', None)]
+        for doc in docs:
+            if not doc.get('_rev', None):
+                doc.pop('_rev', None)
 
-        result = self.session.post(f"{self._url}/_bulk_docs", json={"docs": docs}).json()
-        # update id and rev to _id and _rev for all docs
-        [doc.update({'_id': result[i]['id'], '_rev': result[i]['rev']}) for i, doc in enumerate(docs)]
+        result = self._decode(self._post_json(self._bulk_url, {"docs": docs}))
+
+        # Retry the conflicting documents once with their current revisions, documents deleted in the meantime stay conflicted
+        conflicts = [i for i, res in enumerate(result) if res.get('error') == 'conflict']
+        if conflicts:
+            rows = self._decode(self._post_json(self._all_docs_url, {"keys": [docs[i]['_id'] for i in conflicts]}, idempotent=True))['rows']
+            retry = [(i, row['value']['rev']) for i, row in zip(conflicts, rows) if 'error' not in row and not row['value'].get('deleted')]
+            if retry:
+                retried = self._decode(self._post_json(self._bulk_url, {"docs": [dict(docs[i], _rev=rev) for i, rev in retry]}))
+                for (i, _), res in zip(retry, retried):
+                    result[i] = res
+
+        # update id and rev to _id and _rev for the written docs, failed docs are left untouched
+        failed = []
+        for doc, res in zip(docs, result):
+            if 'rev' in res:
+                doc['_id'], doc['_rev'] = res['id'], res['rev']
+            else:
+                failed.append(res)
+        self._invalidate([doc['_id'] for doc in docs if '_id' in doc])
+
+        if failed:
+            raise RuntimeError(f"Failed to update {len(failed)} of {len(docs)} documents: {failed}")
         return docs
     
     def delete(self, doc: dict) -> dict:
@@ -117,22 +321,78 @@ class Db():
         limit: int: Number of documents to return
         fields: list: List of fields to return
         
-        Returns the documents that match the given query
+        Returns the documents that match the given query, or an empty list if the query fails.
+        Raises httpx.HTTPStatusError if a page after the first one cannot be fetched
+        '''
+        key = orjson.dumps((query, skip, limit, fields), option=orjson.OPT_SORT_KEYS)
+        with self._cache_lock:
+            cached = self._query_cache.get(key)
+            generation = self._cache_generation
+        if cached is not None:
+            return orjson.loads(cached)
+
+        docs = []
+        try:
+            for doc in self.find_iter(query=query, skip=skip, limit=limit, fields=fields):
+                docs.append(doc)
+        except httpx.HTTPStatusError:
+            # A failure after the first page would leave an incomplete result, raise instead of returning it
+            if docs:
+                raise
+            # Failed queries are not cached
+            return []
+
+        if len(docs) > _QUERY_CACHE_MAX_DOCS:
+            return docs
+
+        data = orjson.dumps(docs)
+        if len(data) > _QUERY_CACHE_MAX_ENTRY:
+            return docs
+
+        with self._cache_lock:
+            if generation == self._cache_generation:
+                self._query_cache[key] = data
+        return docs
+
+    def find_iter(self, query: dict={}, skip:int = 0, limit: int = 50000, fields: list = None, page_size: int = 1000) -> Generator[dict, None, None]:
+        '''
+        query: dict: Query selector
+        skip: int: Number of documents to skip
+        limit: int: Number of documents to return
+        fields: list: List of fields to return
+        page_size: int: Number of documents requested per page
+        
+        Returns a generator that yields the documents that match the given query, fetching them page by page with Mango bookmarks.
+        Raises httpx.HTTPStatusError if a page cannot be fetched
         '''
         # Pass the selector and other parameters separately
         selector = {"selector": query}
         
         selector['skip'] = skip
-        selector['limit'] = limit
         if fields: 
             selector['fields'] = fields
 
-        result = self.session.post(f"{self._url}/_find", json=selector)
-        if result.status_code != 200:
-            return []
-        return result.json().get('docs', [])
-        
-    
+        remaining = limit
+        while remaining > 0:
+            selector['limit'] = min(page_size, remaining)
+            result = self._post_json(self._find_url, selector, idempotent=True)
+            if result.status_code != 200:
+                logger.error(f"Error: {result.status_code} {result.text}")
+                result.raise_for_status()
+
+            page = self._decode(result)
+            docs = page.get('docs', [])
+            yield from docs
+
+            remaining -= len(docs)
+            bookmark = page.get('bookmark')
+            if len(docs) < selector['limit'] or not bookmark or bookmark == selector.get('bookmark'):
+                return
+
+            # The bookmark already accounts for the skipped documents
+            selector['skip'] = 0
+            selector['bookmark'] = bookmark
+
     def find_first(self, query: dict = {}, skip: int  = 0, fields: list = None):
         '''
         query: dict: Query selector
@@ -149,35 +409,35 @@ class Db():
         '''
         limit: int: Number of revisions to keep for each document
         '''
-        return self.session.put(f"{self._url}/_revs_limit", json=limit).json()
+        return self._decode(self._put_json(self._revs_limit_url, limit))
 
     def compact(self):
         '''
         Compacts the database
         '''
-        return self.session.post(f"{self._url}/_compact").json()
+        return self._decode(self._request('POST', self._compact_url))
 
     def cleanup(self):
         '''
         Cleans up the database
         '''
-        return self.session.post(f"{self._url}/_view_cleanup").json()
+        return self._decode(self._request('POST', self._cleanup_url))
     
     def deleted_docs(self) -> dict:
         '''
         Returns a dictionary of deleted document ids as keys and and their revisions as values
         '''
-        result = self.session.post(f"{self._url}/_changes", params={'include_docs': "true"}, data=json.dumps({}).encode("utf-8"), json=True)
-        if result.status_code != 200:
-            return []
-        
-        deleted_docs = {}
-        for item in result.json()['results']:
-            doc = item.get('doc', None)
-            if doc and doc.get("_deleted", False):
-                if not deleted_docs.get(doc['_id'], None):
-                    deleted_docs[doc['_id']] = []
-                deleted_docs[doc['_id']].append(doc['_rev'])
+        with self._stream_json(self._changes_url, {}, params={'include_docs': "true"}) as result:
+            if result.status_code != 200:
+                return []
+            
+            deleted_docs = {}
+            for item in self._iter_items(result, 'results.item'):
+                doc = item.get('doc', None)
+                if doc and doc.get("_deleted", False):
+                    if not deleted_docs.get(doc['_id'], None):
+                        deleted_docs[doc['_id']] = []
+                    deleted_docs[doc['_id']].append(doc['_rev'])
         return deleted_docs
     
 
@@ -187,7 +447,9 @@ class Db():
 
         data: dict: Dictionary of document ids as keys and their revisions as values
         '''
-        return self.session.post(f"{self._url}/_purge", json=data).json()
+        result = self._decode(self._post_json(self._purge_url, data))
+        self._invalidate(list(data))
+        return result
 
     def purge_all(self) -> dict:
         '''
@@ -196,26 +458,62 @@ class Db():
         return self.purge(self.deleted_docs())
     
 
-    def changes(self, query: dict = None) -> Generator[dict, None, None]:
+    def changes(self, query: dict = None, max_retries: int = 5) -> Generator[dict, None, None]:
         '''
         query: dict: Query selector
+        max_retries: int: Number of consecutive failed connections after which the error is raised
 
         Returns a generator that yields the changes in the database
         '''
-        params = {"feed":"longpoll", "since":"now", "include_docs": "true", "live": "true"}
+        params = {"feed": "continuous", "since": "now", "include_docs": "true", "heartbeat": 30000}
         data = {}
         if query:
             params['filter']  = '_selector'
             data['selector'] = query
-            
+
+        # A single streamed request delivers one change per line, reconnect from the last seq only if it drops
+        failures = 0
         while True:
-            response = self.session.post(f"{self._url}/_changes", params=params, json=data, stream=True)
+            received = False
             try:
-                for res in response.json()['results']:
-                    yield res['doc']
-            except Exception as e:
-                logger.error(f"Error: {e}")
-                break
+                with self._stream_json(self._changes_url, data, params=params) as response:
+                    if response.status_code != 200:
+                        response.read()
+                        logger.error(f"Error: {response.status_code} {response.text}")
+                        return
+
+                    for line in response.iter_lines():
+                        received = True
+                        failures = 0
+                        # Empty lines are heartbeats
+                        if not line:
+                            continue
+                        change = orjson.loads(line)
+                        if 'last_seq' in change:
+                            params['since'] = change['last_seq']
+                            break
+                        params['since'] = change['seq']
+                        yield change['doc']
+
+                if received:
+                    continue
+                # A stream closed without any line, e.g. by a proxy dropping idle connections, counts as a failure
+                failures += 1
+                if failures > max_retries:
+                    logger.error(f"Error: the changes feed keeps closing without data, giving up after {max_retries} retries")
+                    return
+                reason = "the changes feed closed without data"
+            except httpx.HTTPError as e:
+                failures += 1
+                if failures > max_retries:
+                    logger.error(f"Error: {e}, giving up after {max_retries} retries")
+                    raise
+                reason = e
+
+            # Back off exponentially between reconnects, capped at 30 seconds
+            delay = min(0.5 * 2 ** (failures - 1), 30)
+            logger.error(f"Error: {reason}, reconnecting in {delay}s")
+            time.sleep(delay)
     
     def close(self):
         '''
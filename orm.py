@@ -1,10 +1,73 @@
+import os
+import sys
+import logging
+import orjson
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 from datetime import datetime
 from uuid import uuid4
-from typing import Any, List, Dict, Union, get_origin, get_args
+from typing import Any, Callable, List, Dict, Union, get_origin, get_args
 from dataclasses import dataclass, field, fields, is_dataclass, MISSING
 from core import db
 
+logger = logging.getLogger(__name__)
+
+# Per-class serializer and deserializer functions generated by _compile_serializer and _compile_deserializer
+_SER_CACHE: Dict[type, Callable[[Any], Dict[str, Any]]] = {}
+_DESER_CACHE: Dict[type, Callable[[Dict[str, Any]], Any]] = {}
+
+# Worker pool deserializing large result sets, see Orm.find. Deserialization is pure Python and holds the GIL,
+# so the pool is only created on free-threaded builds where the workers actually run in parallel
+_FREE_THREADED = not getattr(sys, "_is_gil_enabled", lambda: True)()
+_POOL = ThreadPoolExecutor(max_workers=os.cpu_count()) if _FREE_THREADED else None
+_PARALLEL_THRESHOLD = 1000
+_CHUNK_SIZE = 256
+
+# Per-class list of field names requested from CouchDB, see _projection
+_PROJECTION_CACHE: Dict[type, List[str]] = {}
+
+# Expressions deserializing a non None value `_v` of these types, inlined by _compile_deserializer
+_INLINE_CONVERTERS = {
+    Decimal: "_Decimal(_v)",
+    datetime: "_datetime.fromisoformat(_v)",
+    int: "int(_v)",
+    float: "float(_v)",
+    str: "str(_v)",
+    bool: "bool(_v)",
+}
+
+# Types that are already JSON values and are returned by _serialize_value as they are
+_JSON_NATIVE = frozenset({int, float, str, bool, type(None)})
+
+# Options for serialize_bytes. Dataclasses go through _orjson_default because orjson skips fields
+# starting with an underscore such as _id and _rev, non string keys are written as strings like json.dumps does
+_ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+
+def _serialize_value(value: Any) -> Any:
+    value_type = type(value)
+    if value_type in _JSON_NATIVE:
+        return value
+    # Lists and dicts holding only JSON values are copied in one step instead of converting every item,
+    # the copy keeps the serialized document independent from the instance
+    elif value_type is list and all(type(item) in _JSON_NATIVE for item in value):
+        return value.copy()
+    elif value_type is dict and all(type(val) in _JSON_NATIVE for val in value.values()):
+        return value.copy()
+    elif isinstance(value, Decimal):
+        return str(value)
+    elif isinstance(value, datetime):
+        return value.isoformat()
+    elif is_dataclass(value):
+        return serialize(value)
+    elif isinstance(value, list):
+        return [_serialize_value(item) for item in value]
+    elif isinstance(value, dict):
+        return {key: _serialize_value(val) for key, val in value.items()}
+    else:
+        return value
+
 def serialize(model_instance: Any) -> Dict[str, Any]:
     """
     Serializes a dataclass instance into a dictionary, handling nested dataclasses,
@@ -16,144 +79,319 @@ def serialize(model_instance: Any) -> Dict[str, Any]:
     Returns:
         Dict[str, Any]: A dictionary representation of the dataclass.
     """
-    if not is_dataclass(model_instance):
-        raise ValueError("serialize function expects a dataclass instance")
-    
-    def serialize_value(value: Any) -> Any:
-        if isinstance(value, Decimal):
-            return str(value)
-        elif isinstance(value, datetime):
-            return value.isoformat()
-        elif is_dataclass(value):
-            return serialize(value)
-        elif isinstance(value, list):
-            return [serialize_value(item) for item in value]
-        elif isinstance(value, dict):
-            return {key: serialize_value(val) for key, val in value.items()}
-        else:
-            return value
+    serializer = _SER_CACHE.get(type(model_instance))
+    if serializer is None:
+        if not is_dataclass(model_instance):
+            raise ValueError("serialize function expects a dataclass instance")
+        serializer = _SER_CACHE[type(model_instance)] = _compile_serializer(type(model_instance))
 
-    serialized_data = {}
-    model_fields = fields(model_instance)
-    for field in model_fields:
-        value = getattr(model_instance, field.name)
-        serialized_data[field.name] = serialize_value(value)
-    
-    return serialized_data
+    return serializer(model_instance)
 
-def deserialize(model_class: Any, data: Dict[str, Any]) -> Any:
+def _orjson_default(value: Any) -> Any:
+    if is_dataclass(value):
+        return {name: getattr(value, name) for name in _projection(type(value))}
+    elif isinstance(value, Decimal):
+        return str(value)
+    elif isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def serialize_bytes(model_instance: Any) -> bytes:
     """
-    Deserializes a dictionary into a dataclass instance, handling nested dataclasses,
-    lists, dictionaries, and special types like Decimal and datetime.
+    Serializes a dataclass instance straight to JSON bytes with orjson, without building
+    the intermediate dictionary. Produces the same document as `serialize`, except that
+    a None _rev is left out because CouchDB rejects it.
     
     Args:
-        model_class (Any): The dataclass type to deserialize into.
-        data (Dict[str, Any]): The dictionary containing the data.
+        model_instance (Any): The dataclass instance to serialize.
         
     Returns:
-        Any: An instance of `model_class` populated with the deserialized data.
+        bytes: The JSON representation of the dataclass.
     """
-    if not is_dataclass(model_class):
-        raise ValueError("deserialize function expects a dataclass type")
+    if not is_dataclass(model_instance):
+        raise ValueError("serialize_bytes function expects a dataclass instance")
+
+    data = _orjson_default(model_instance)
+    if '_rev' in data and data['_rev'] is None:
+        del data['_rev']
+    return orjson.dumps(data, default=_orjson_default, option=_ORJSON_OPTIONS)
+
+def _compile_serializer(model_class: Any) -> Callable[[Any], Dict[str, Any]]:
+    """
+    Generates a function serializing instances of the given dataclass type.
+    Values whose runtime type matches the field annotation are converted inline,
+    anything else falls back to `_serialize_value`.
+    """
+    namespace = {'_serialize_value': _serialize_value, '_serialize': serialize}
+    lines = ["def _ser(_o):"]
+    items = []
+    for i, field in enumerate(fields(model_class)):
+        field_type = _unwrap_optional(field.type)
+        value = f"_v{i}"
+        lines.append(f"    {value} = _o.{field.name}")
+        namespace[f"_t{i}"] = field_type
+        if field_type in (str, int, float, bool):
+            expression = f"{value} if {value}.__class__ is _t{i} or {value} is None else _serialize_value({value})"
+        elif field_type is Decimal:
+            expression = f"str({value}) if {value}.__class__ is _t{i} else _serialize_value({value})"
+        elif field_type is datetime:
+            expression = f"{value}.isoformat() if {value}.__class__ is _t{i} else _serialize_value({value})"
+        elif is_dataclass(field_type):
+            expression = f"_serialize({value}) if {value}.__class__ is _t{i} else _serialize_value({value})"
+        else:
+            expression = f"_serialize_value({value})"
+        items.append(f"{field.name!r}: {expression}")
+    lines.append(f"    return {{{', '.join(items)}}}")
+    exec("\n".join(lines), namespace)
+    return namespace['_ser']
+
+def _unwrap_optional(field_type: Any) -> Any:
+    """
+    Returns T for Optional[T], otherwise the field type itself.
+    """
+    args = get_args(field_type)
+    if get_origin(field_type) is Union and type(None) in args:
+        non_none_types = [arg for arg in args if arg is not type(None)]
+        if len(non_none_types) == 1:
+            return non_none_types[0]
+    return field_type
+
+def _make_converter(field_type: Any) -> Callable[[Any], Any]:
+    """
+    Builds a function that deserializes a single value of the given field type.
+    The type is inspected once, so the returned function does no type dispatch.
+    """
+    # Handle Optional[T] (which is Union[T, NoneType])
+    field_type = _unwrap_optional(field_type)
+    origin = get_origin(field_type)
+    args = get_args(field_type)
     
-    def deserialize_value(field_type: Any, value: Any) -> Any:
-        """
-        Deserializes a single value based on the field type.
-        """
-        if value is None:
-            return None
-        
-        origin = get_origin(field_type)
-        args = get_args(field_type)
-        
-        # Handle Optional[T] (which is Union[T, NoneType])
-        if origin is Union and type(None) in args:
-            non_none_types = [arg for arg in args if arg is not type(None)]
-            if len(non_none_types) == 1:
-                return deserialize_value(non_none_types[0], value)
-        
-        # Handle List[T]
-        if origin is list or origin is List:
+    # Handle List[T]
+    if origin is list or origin is List:
+        convert_item = _make_converter(args[0] if args else Any)
+        def convert_list(value):
+            if value is None:
+                return None
             if not isinstance(value, list):
                 raise TypeError(f"Expected list for field, got {type(value).__name__}")
-            item_type = args[0] if args else Any
-            return [deserialize_value(item_type, item) for item in value]
-        
-        # Handle Dict[K, V]
-        if origin is dict or origin is Dict:
+            return [convert_item(item) for item in value]
+        return convert_list
+    
+    # Handle Dict[K, V]
+    if origin is dict or origin is Dict:
+        key_type, val_type = args if args else (Any, Any)
+        convert_key, convert_val = _make_converter(key_type), _make_converter(val_type)
+        def convert_dict(value):
+            if value is None:
+                return None
             if not isinstance(value, dict):
                 raise TypeError(f"Expected dict for field, got {type(value).__name__}")
-            key_type, val_type = args if args else (Any, Any)
-            return {deserialize_value(key_type, k): deserialize_value(val_type, v) for k, v in value.items()}
-        
-        # Handle nested dataclasses
-        if is_dataclass(field_type):
+            return {convert_key(k): convert_val(v) for k, v in value.items()}
+        return convert_dict
+    
+    # Handle nested dataclasses
+    if is_dataclass(field_type):
+        def convert_dataclass(value):
+            if value is None:
+                return None
             if not isinstance(value, dict):
                 raise TypeError(f"Expected dict for dataclass field, got {type(value).__name__}")
             return deserialize(field_type, value)
-        
-        # Handle special types
-        if field_type is Decimal:
-            return Decimal(value)
-        elif field_type is datetime:
-            return datetime.fromisoformat(value)
-        elif field_type is int:
-            return int(value)
-        elif field_type is float:
-            return float(value)
-        elif field_type is str:
-            return str(value)
-        elif field_type is bool:
-            return bool(value)
-        
-        # Fallback for other types
-        return value
+        return convert_dataclass
     
-    deserialized_data = {}
-    for field in fields(model_class):
-        field_name = field.name
-        field_type = field.type
-        if field_name in data:
-            raw_value = data[field_name]
-            try:
-                deserialized_data[field_name] = deserialize_value(field_type, raw_value)
-            except Exception as e:
-                raise ValueError(f"Error deserializing field '{field_name}': {e}") from e
+    # Handle special types
+    if field_type is Decimal:
+        return lambda value: None if value is None else Decimal(value)
+    elif field_type is datetime:
+        return lambda value: None if value is None else datetime.fromisoformat(value)
+    elif field_type is int:
+        return lambda value: None if value is None else int(value)
+    elif field_type is float:
+        return lambda value: None if value is None else float(value)
+    elif field_type is str:
+        return lambda value: None if value is None else str(value)
+    elif field_type is bool:
+        return lambda value: None if value is None else bool(value)
+    
+    # Fallback for other types
+    return lambda value: value
+
+def _compile_deserializer(model_class: Any) -> Callable[[Dict[str, Any]], Any]:
+    """
+    Generates a function deserializing dictionaries into instances of the given dataclass type.
+    Special types are converted inline, containers and nested dataclasses through `_make_converter`.
+    """
+    namespace = {'_cls': model_class, '_Decimal': Decimal, '_datetime': datetime}
+    lines = ["def _de(_d):"]
+    arguments = []
+    for i, field in enumerate(fields(model_class)):
+        field_type = _unwrap_optional(field.type)
+        if field_type in _INLINE_CONVERTERS:
+            conversion = _INLINE_CONVERTERS[field_type]
+        else:
+            namespace[f"_c{i}"] = _make_converter(field_type)
+            conversion = f"_c{i}(_v)"
+
+        # Handle missing fields, possibly with default values
+        if field.default is not MISSING:
+            namespace[f"_default{i}"] = field.default
+            default = f"_default{i}"
+        elif field.default_factory is not MISSING:
+            namespace[f"_factory{i}"] = field.default_factory
+            default = f"_factory{i}()"
         else:
-            # Handle missing fields, possibly with default values
-            if field.default is not MISSING:
-                deserialized_data[field_name] = field.default
-            elif field.default_factory is not MISSING:
-                deserialized_data[field_name] = field.default_factory()
-            else:
-                deserialized_data[field_name] = None  # or raise an error
+            default = "None"
+
+        lines += [
+            f"    if {field.name!r} in _d:",
+            f"        _v = _d[{field.name!r}]",
+            f"        try:",
+            f"            _a{i} = None if _v is None else {conversion}",
+            f"        except Exception as e:",
+            f"            raise ValueError(f\"Error deserializing field '{field.name}': {{e}}\") from e",
+            f"    else:",
+            f"        _a{i} = {default}",
+        ]
+        arguments.append(f"{field.name}=_a{i}")
+    lines.append(f"    return _cls({', '.join(arguments)})")
+    exec("\n".join(lines), namespace)
+    return namespace['_de']
+
+def deserialize(model_class: Any, data: Dict[str, Any]) -> Any:
+    """
+    Deserializes a dictionary into a dataclass instance, handling nested dataclasses,
+    lists, dictionaries, and special types like Decimal and datetime.
     
-    return model_class(**deserialized_data)
+    Args:
+        model_class (Any): The dataclass type to deserialize into.
+        data (Dict[str, Any]): The dictionary containing the data.
+        
+    Returns:
+        Any: An instance of `model_class` populated with the deserialized data.
+    """
+    deserializer = _DESER_CACHE.get(model_class)
+    if deserializer is None:
+        if not is_dataclass(model_class):
+            raise ValueError("deserialize function expects a dataclass type")
+        deserializer = _DESER_CACHE[model_class] = _compile_deserializer(model_class)
+
+    return deserializer(data)
+
+def _projection(model_class: Any) -> List[str]:
+    """
+    Returns the names of the fields declared by a dataclass type, including _id and _rev,
+    so queries only transfer the fields that deserialize populates.
+    """
+    projection = _PROJECTION_CACHE.get(model_class)
+    if projection is None:
+        projection = _PROJECTION_CACHE[model_class] = [field.name for field in fields(model_class)]
+    return projection
+
+class _PendingQueue():
+    '''
+    Collects instances saved in batched mode and writes them with a single _bulk_docs request,
+    either once `max_batch` instances are queued or `delay` seconds after the first one
+    '''
+    def __init__(self, delay: float = 0.1, max_batch: int = 500) -> None:
+        self.delay = delay
+        self.max_batch = max_batch
+        self._items = []
+        self._queued = set()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, instance: Any) -> None:
+        with self._lock:
+            # An instance saved again before the flush is written once, with its latest state
+            if id(instance) in self._queued:
+                return
+            self._queued.add(id(instance))
+            self._items.append(instance)
+            full = len(self._items) >= self.max_batch
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.delay, self._flush_in_background)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            items, self._items = self._items, []
+            self._queued.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if items:
+            try:
+                Orm.save_many(items)
+            except Exception:
+                logger.exception(f"Failed to save {len(items)} batched documents")
+                raise
+
+    def _flush_in_background(self) -> None:
+        # Exceptions raised in the timer thread never reach the caller, flush already logged them
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+_pending = _PendingQueue()
+atexit.register(_pending.flush)
 
 @dataclass
 class Orm():
     _id: str = field(default_factory=lambda: str(uuid4()))
     _rev: str = None
 
+    # When True, save() queues the instance and writes it with the next _bulk_docs batch
+    batched = False
+
     @classmethod
     def load(cls, id) -> 'Orm':
         '''
         Load a class by its _id
         '''
-        doc = db.get(id)
+        doc = db.get_projected(id, _projection(cls))
         if not doc:
             return None
         
         return deserialize(cls, doc)
 
+    @classmethod
+    def load_many(cls, ids) -> List['Orm']:
+        '''
+        Load several classes by their _id with a single request
+        '''
+        return [deserialize(cls, doc) for doc in db.bulk_get(ids)]
+
     def save(self) -> 'Orm':
         '''
         Save the class instance
         '''
-        doc = serialize(self)
-        doc = db.put(doc)
+        if self.batched:
+            _pending.add(self)
+            return self
+
+        doc = db.put({'_id': self._id, '_rev': self._rev}, body=serialize_bytes(self))
         self._id, self._rev = doc['_id'], doc['_rev']
         return self
+
+    @classmethod
+    def save_many(cls, instances: List['Orm']) -> List['Orm']:
+        '''
+        Save several class instances with a single bulk request
+
+        instances (list): The instances to save
+        '''
+        docs = [serialize(instance) for instance in instances]
+        try:
+            db.bulk_update(docs)
+        finally:
+            # Documents that failed keep their previous _id and _rev
+            for instance, doc in zip(instances, docs):
+                instance._id, instance._rev = doc['_id'], doc.get('_rev')
+        return instances
     
     def dict(self) -> Dict[str, Any]:
         '''
@@ -169,8 +407,14 @@ class Orm():
         query (dict): The query to match the documents
         '''
 
-        docs = db.find(query=query)
-        return [deserialize(cls, doc) for doc in docs]
+        docs = db.find(query=query, fields=_projection(cls))
+        if _POOL is None or len(docs) <= _PARALLEL_THRESHOLD:
+            return [deserialize(cls, doc) for doc in docs]
+
+        # ThreadPoolExecutor.map does not chunk, so hand each worker a slice of documents
+        chunks = [docs[i:i + _CHUNK_SIZE] for i in range(0, len(docs), _CHUNK_SIZE)]
+        results = _POOL.map(lambda chunk: [deserialize(cls, doc) for doc in chunk], chunks)
+        return [instance for chunk in results for instance in chunk]
     
     @classmethod
     def find_first(cls, query={}) -> 'Orm':
@@ -179,5 +423,5 @@ class Orm():
         
         query (dict): The query to match the document
         '''
-        docs = cls.find(query)
-        return docs[0] if len(docs) > 0 else None
\ No newline at end of file
+        doc = db.find_first(query=query, fields=_projection(cls))
+        return deserialize(cls, doc) if doc else None
\ No newline at end of file